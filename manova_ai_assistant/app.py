@@ -1,22 +1,115 @@
 import os
-import json
+import re
+import asyncio
+import orjson
+import mmap
+import hashlib
+import atexit
+import sqlite3
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
-from pypdf import PdfReader
+import pymupdf
+import numpy as np
+from aiolimiter import AsyncLimiter
+from sentence_transformers import SentenceTransformer
 import gradio as gr
-from groq import Groq
+from groq import AsyncGroq
 
 load_dotenv(override=True)
 
+CACHE_DIR = os.path.expanduser("~/.cache/manova")
+KB_CACHE_PATH = os.path.join(CACHE_DIR, "knowledge_base.cache.json")
+# Cached text is only valid for the extractor that produced it; bump the revision when extraction logic changes
+KB_EXTRACT_REVISION = 2
+KB_EXTRACTOR = f"pymupdf-{pymupdf.VersionBind}-r{KB_EXTRACT_REVISION}"
+KB_VECS_PATH = os.path.join(CACHE_DIR, "kb_vecs.npz")
+RESPONSE_CACHE_PATH = os.path.join(CACHE_DIR, "chat_cache.sqlite")
+RESPONSE_CACHE_SIZE = 512
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+KB_CHUNK_CHARS = 1200  # roughly 300 tokens
+KB_TOP_K = 5
+DOC_POLL_SECONDS = 60
+UNKNOWN_DEDUPE_SECONDS = 60
+UNKNOWN_EVICT_SECONDS = 300
+DOC_PATHS = {
+    "pdf": [
+        "me/cv.pdf",
+        "knowledge_base/ManovaLebaku Moses.pdf"
+    ],
+    "text": [
+        "me/summary.txt"
+    ],
+    "images": [
+        "knowledge_base/certifications/WhatsApp Image 2024-04-18 at 2.59.18 PM (4).jpeg"
+    ]
+}
+# Groq free-tier limits for llama-3.3-70b; override to match the account's plan
+GROQ_RPM = int(os.getenv("GROQ_RPM", 30))
+# TPM counts prompt and completion tokens, so each request is charged its prompt (about 4 chars
+# per token) plus the GROQ_MAX_TOKENS completion allowance it could use, not only what it sends
+GROQ_TPM = int(os.getenv("GROQ_TPM", 6000))
+GROQ_MAX_TOKENS = int(os.getenv("GROQ_MAX_TOKENS", 1024))
+# Chats allowed to stream at once, shared by the Enter and Send events; the rate limiters queue the rest
+CHAT_CONCURRENCY = int(os.getenv("CHAT_CONCURRENCY", 16))
+_UNKNOWN_RE = re.compile(r"i don't know|cannot answer|not in my knowledge base|no information", re.IGNORECASE)
+
+def chunk_text(text, max_chars=KB_CHUNK_CHARS):
+    """Split text into chunks of at most max_chars, breaking on paragraphs, then lines"""
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if len(paragraph) <= max_chars:
+            if paragraph:
+                pieces.append(paragraph)
+            continue
+        for line in paragraph.splitlines():
+            line = line.strip()
+            pieces.extend(line[i:i + max_chars] for i in range(0, len(line), max_chars))
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + 1 + len(piece) > max_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current}\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+# Notifications are sent in the background over a pooled keep-alive connection;
+# failed connects are retried, but a POST that reached Pushover is never resent
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4, max_retries=Retry(total=2, backoff_factor=0.3)))
+_notify_pool = ThreadPoolExecutor(max_workers=2)
+atexit.register(_notify_pool.shutdown, wait=True)
+
+def _do_push(text):
+    try:
+        _session.post(
+            "https://api.pushover.net/1/messages.json",
+            data={
+                "token": os.getenv("PUSHOVER_TOKEN"),
+                "user": os.getenv("PUSHOVER_USER"),
+                "message": text,
+            },
+            timeout=10
+        )
+    except requests.RequestException as e:
+        print(f"Failed to send notification: {e}")
+
 def push(text):
-    requests.post(
-        "https://api.pushover.net/1/messages.json",
-        data={
-            "token": os.getenv("PUSHOVER_TOKEN"),
-            "user": os.getenv("PUSHOVER_USER"),
-            "message": text,
-        }
-    )
+    _notify_pool.submit(_do_push, text)
 
 def record_user_details(email, name="Name not provided", notes="not provided"):
     push(f"Recording {name} with email {email} and notes {notes}")
@@ -61,47 +154,155 @@ tools = [
 
 class Me:
     def __init__(self):
-        self.groq = Groq()
+        self.groq = AsyncGroq()
+        self._bucket = AsyncLimiter(GROQ_RPM, 60)
+        self._token_bucket = AsyncLimiter(GROQ_TPM, 60)
         self.name = "Manova"
         self.knowledge_base_text = ""
         self.image_paths = []
-        self._load_documents()
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_db = self._open_response_cache()
+        # SQLite calls block on disk, so they stay off the event loop: reads go through
+        # asyncio.to_thread, writes through a single writer thread, both serialised on _db_lock
+        self._db_lock = threading.Lock()
+        self._db_writer = ThreadPoolExecutor(max_workers=1)
+        self._recent_unknowns = OrderedDict()
+        # Load the model and documents in the background so the UI can come up immediately
+        self._ready = threading.Event()
+        self._load_error = None
+        self._embedder = None
+        self._watching = False
+        self._dirty = threading.Event()
+        self._reload_lock = threading.Lock()
+        threading.Thread(target=self._load_and_signal, daemon=True).start()
+
+    def _load_and_signal(self):
+        try:
+            if self._embedder is None:
+                self._embedder = SentenceTransformer(EMBEDDING_MODEL)
+            self._load_documents()
+            self._load_semantic_cache()
+            if not self._watching:
+                self._watching = True
+                threading.Thread(target=self._watch_documents, daemon=True).start()
+            self._load_error = None
+        except Exception as e:
+            print(f"Failed to load knowledge base: {e}")
+            self._load_error = e
+        finally:
+            self._ready.set()
+
+    def _retry_load(self):
+        """Run a failed startup load again; callers arriving meanwhile wait on the lock for the same attempt"""
+        with self._reload_lock:
+            if self._load_error is not None:
+                self._load_and_signal()
+        if self._load_error is not None:
+            raise RuntimeError("Knowledge base failed to load") from self._load_error
+
+    def _doc_mtimes(self):
+        mtimes = {}
+        for paths in DOC_PATHS.values():
+            for path in paths:
+                try:
+                    mtimes[path] = os.stat(path).st_mtime_ns
+                except OSError:
+                    mtimes[path] = None
+        return mtimes
+
+    def _watch_documents(self):
+        """Poll the tracked documents and flag a reload when any of them changes"""
+        while True:
+            time.sleep(DOC_POLL_SECONDS)
+            if self._doc_mtimes() != self._doc_snapshot:
+                self._dirty.set()
+
+    def _reload_documents(self):
+        with self._reload_lock:
+            if not self._dirty.is_set():
+                return
+            self._dirty.clear()
+            print("Documents changed, reloading knowledge base")
+            try:
+                self._load_documents()
+                self._load_semantic_cache()
+            except Exception as e:
+                # The snapshot is only updated on success, so the watcher flags the change again on its next poll
+                print(f"Failed to reload knowledge base, keeping the previous one: {e}")
+
+    def _read_kb_cache(self):
+        try:
+            with open(KB_CACHE_PATH, "rb") as f:
+                return orjson.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+
+    def _write_kb_cache(self, cache):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = KB_CACHE_PATH + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(cache))
+        os.replace(tmp_path, KB_CACHE_PATH)
+
+    def _load_or_cache(self, pdf_path, cache):
+        """Extract PDF text, reusing the cached text when the file contents are unchanged"""
+        if os.stat(pdf_path).st_size == 0:
+            return "", ""
+        with open(pdf_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            key = f"{KB_EXTRACTOR}:{hashlib.sha256(mm).hexdigest()}"
+            if key in cache:
+                print(f"Using cached text for {pdf_path}")
+                return key, cache[key]
+            # Parse straight from the mapping used for hashing, without copying the file into a bytes object
+            with memoryview(mm) as buf:
+                return key, self._extract_pdf_text(pdf_path, buf)
+
+    def _extract_pdf_text(self, pdf_path, buf):
+        text = ""
+        doc = pymupdf.open(stream=buf, filetype="pdf")
+        try:
+            for i, page in enumerate(doc):
+                page_text = page.get_text("text")
+                if page_text.strip():
+                    text += "\n" + page_text
+                    print(f"Loaded page {i+1} of {pdf_path} with {len(page_text)} chars")
+                else:
+                    print(f"No text found on page {i+1} of {pdf_path}")
+        finally:
+            doc.close()
+        return text
 
     def _load_documents(self):
         """Load documents from multiple formats and paths"""
-        doc_paths = {
-            "pdf": [
-                "me/cv.pdf",
-                "knowledge_base/ManovaLebaku Moses.pdf"
-            ],
-            "text": [
-                "me/summary.txt"
-            ],
-            "images": [
-                "knowledge_base/certifications/WhatsApp Image 2024-04-18 at 2.59.18 PM (4).jpeg"
-            ]
-        }
+        doc_paths = DOC_PATHS
+        doc_snapshot = self._doc_mtimes()  # Taken first so edits made during loading are still seen
 
-        self.knowledge_base_text = ""  # Reset before loading
+        # Everything is built into locals and published at the end, so a failed reload leaves the old state intact
+        knowledge_base_text = ""
 
-        # Load PDF text
+        # Load PDF text, skipping extraction for files already in the cache
+        kb_cache = self._read_kb_cache()
+        fresh_cache = {}
         for pdf_path in doc_paths["pdf"]:
             if os.path.exists(pdf_path):
                 print(f"Loading PDF: {pdf_path}")
                 try:
-                    reader = PdfReader(pdf_path)
-                    for i, page in enumerate(reader.pages):
-                        text = page.extract_text()
-                        if text:
-                            self.knowledge_base_text += "\n" + text
-                            print(f"Loaded page {i+1} of {pdf_path} with {len(text)} chars")
-                        else:
-                            print(f"No text found on page {i+1} of {pdf_path}")
+                    cache_key, text = self._load_or_cache(pdf_path, kb_cache)
+                    if cache_key:
+                        fresh_cache[cache_key] = text
+                    knowledge_base_text += text
                 except Exception as e:
                     print(f"Failed to read PDF {pdf_path}: {e}")
             else:
                 print(f"PDF not found: {pdf_path}")
 
+        if fresh_cache != kb_cache:
+            try:
+                self._write_kb_cache(fresh_cache)
+            except OSError as e:
+                print(f"Failed to write knowledge base cache: {e}")
+
         # Load text files
         for txt_path in doc_paths["text"]:
             if os.path.exists(txt_path):
@@ -109,7 +310,7 @@ class Me:
                 try:
                     with open(txt_path, "r", encoding="utf-8") as f:
                         content = f.read()
-                        self.knowledge_base_text += "\n" + content
+                        knowledge_base_text += "\n" + content
                         print(f"Loaded text file {txt_path} with {len(content)} chars")
                 except Exception as e:
                     print(f"Failed to read text file {txt_path}: {e}")
@@ -117,69 +318,337 @@ class Me:
                 print(f"Text file not found: {txt_path}")
 
         # Store image paths (just existence check)
-        self.image_paths = [p for p in doc_paths["images"] if os.path.exists(p)]
-        print(f"Loaded {len(self.image_paths)} image paths")
-
-        print(f"Total knowledge base length: {len(self.knowledge_base_text)} characters")
+        image_paths = [p for p in doc_paths["images"] if os.path.exists(p)]
+        print(f"Loaded {len(image_paths)} image paths")
+
+        print(f"Total knowledge base length: {len(knowledge_base_text)} characters")
+
+        # Embed the knowledge base once so each request only carries the relevant chunks
+        kb_chunks = chunk_text(knowledge_base_text)
+        if kb_chunks:
+            kb_vecs = self._embed_chunks(kb_chunks)
+        else:
+            kb_vecs = np.empty((0, self._embedder.get_sentence_embedding_dimension()), dtype=np.float32)
+        print(f"Embedded {len(kb_chunks)} knowledge base chunks")
+
+        # The instructions never change between requests, so the system message is built once
+        system_message = {"role": "system", "content": self._build_system_prompt()}
+
+        # Cached answers and question embeddings are only valid for the prompt, knowledge base and model they came from
+        prompt_key = hashlib.blake2b(orjson.dumps([EMBEDDING_MODEL, system_message["content"], knowledge_base_text])).hexdigest()
+
+        self.knowledge_base_text = knowledge_base_text
+        self.image_paths = image_paths
+        # One immutable tuple, replaced in a single store, so a concurrent reader never pairs new chunks with old vectors
+        self._kb = (kb_chunks, kb_vecs)
+        self._system_message = system_message
+        self._prompt_key = prompt_key
+        self._doc_snapshot = doc_snapshot
+
+    def _embed_chunks(self, chunks):
+        """Embed chunks in one batched call, reusing the vectors on disk when the chunks are unchanged"""
+        key = hashlib.blake2b(orjson.dumps([EMBEDDING_MODEL, chunks])).hexdigest()
+        try:
+            with np.load(KB_VECS_PATH) as cached:
+                if str(cached["key"]) == key and cached["vecs"].dtype == np.float32:
+                    print("Using cached knowledge base embeddings")
+                    return cached["vecs"]
+        except FileNotFoundError:
+            pass
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            print(f"Failed to read knowledge base embeddings cache: {e}")
+
+        vecs = self._embedder.encode(
+            chunks, batch_size=64, normalize_embeddings=True, show_progress_bar=False, convert_to_numpy=True
+        ).astype(np.float32)
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp_path = KB_VECS_PATH + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, key=key, vecs=vecs)
+            os.replace(tmp_path, KB_VECS_PATH)
+        except OSError as e:
+            print(f"Failed to write knowledge base embeddings cache: {e}")
+        return vecs
+
+    def _open_response_cache(self):
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            db = sqlite3.connect(RESPONSE_CACHE_PATH, check_same_thread=False)
+            db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, answer TEXT)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS semantic_cache "
+                "(prompt_key TEXT, vec_hash TEXT, vec BLOB, answer TEXT, PRIMARY KEY (prompt_key, vec_hash))"
+            )
+            db.commit()
+            return db
+        except (OSError, sqlite3.Error) as e:
+            print(f"Response cache persistence disabled: {e}")
+            return None
+
+    def _cache_key(self, history, message):
+        payload = orjson.dumps([self._prompt_key, history, message], default=str)
+        return hashlib.blake2b(payload).hexdigest()
+
+    def _cached_answer(self, key):
+        """Look up an answer in the in-memory LRU"""
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        return None
+
+    def _stored_answer(self, key):
+        """Look up an answer in the SQLite store; blocking, so call it from a worker thread"""
+        if self._cache_db is None:
+            return None
+        with self._db_lock:
+            row = self._cache_db.execute("SELECT answer FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self._remember_answer(key, row[0], persist=False)
+        return row[0]
+
+    def _remember_answer(self, key, answer, persist=True):
+        with self._cache_lock:
+            self._cache[key] = answer
+            self._cache.move_to_end(key)
+            if len(self._cache) > RESPONSE_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        if persist and self._cache_db is not None:
+            self._db_writer.submit(self._write_answer, key, answer)
+
+    def _write_answer(self, key, answer):
+        try:
+            with self._db_lock:
+                self._cache_db.execute("INSERT OR REPLACE INTO responses (key, answer) VALUES (?, ?)", (key, answer))
+                # Keep only the most recently written answers on disk
+                self._cache_db.execute(
+                    "DELETE FROM responses WHERE rowid NOT IN (SELECT rowid FROM responses ORDER BY rowid DESC LIMIT ?)",
+                    (RESPONSE_CACHE_SIZE,)
+                )
+                self._cache_db.commit()
+        except sqlite3.Error as e:
+            print(f"Failed to persist cached answer: {e}")
+
+    def _load_semantic_cache(self):
+        """Restore the most recent question embeddings stored for the current system prompt"""
+        rows = []
+        if self._cache_db is not None:
+            with self._db_lock:
+                # Entries for an older prompt or knowledge base can never match again
+                self._cache_db.execute("DELETE FROM semantic_cache WHERE prompt_key != ?", (self._prompt_key,))
+                self._cache_db.commit()
+                rows = self._cache_db.execute(
+                    "SELECT vec, answer FROM semantic_cache WHERE prompt_key = ? ORDER BY rowid DESC LIMIT ?",
+                    (self._prompt_key, RESPONSE_CACHE_SIZE)
+                ).fetchall()[::-1]
+        if rows:
+            cache_vecs = np.stack([np.frombuffer(vec, dtype=np.float32) for vec, _ in rows])
+        else:
+            cache_vecs = np.empty((0, self._embedder.get_sentence_embedding_dimension()), dtype=np.float32)
+        with self._cache_lock:
+            self._cache_vecs = cache_vecs
+            self._cache_answers = [answer for _, answer in rows]
+        print(f"Loaded {len(rows)} semantic cache entries")
+
+    def _embed(self, text):
+        return self._embedder.encode([text], normalize_embeddings=True, convert_to_numpy=True)[0].astype(np.float32)
+
+    def _semantic_answer(self, query_vec):
+        """Return the answer of the most similar cached question, if it is close enough"""
+        with self._cache_lock:
+            if not self._cache_answers:
+                return None
+            sims = self._cache_vecs @ query_vec
+            best = int(np.argmax(sims))
+            if sims[best] > SEMANTIC_CACHE_THRESHOLD:
+                return self._cache_answers[best]
+        return None
+
+    def _remember_semantic(self, query_vec, answer):
+        with self._cache_lock:
+            # A repeated question replaces its earlier entry instead of adding a duplicate row
+            same = np.flatnonzero((self._cache_vecs == query_vec).all(axis=1))
+            if same.size:
+                drop = set(same.tolist())
+                self._cache_vecs = np.delete(self._cache_vecs, same, axis=0)
+                self._cache_answers = [a for i, a in enumerate(self._cache_answers) if i not in drop]
+            self._cache_vecs = np.vstack([self._cache_vecs, query_vec[None, :]])[-RESPONSE_CACHE_SIZE:]
+            self._cache_answers = (self._cache_answers + [answer])[-RESPONSE_CACHE_SIZE:]
+        if self._cache_db is not None:
+            self._db_writer.submit(self._write_semantic, self._prompt_key, query_vec.tobytes(), answer)
+
+    def _write_semantic(self, prompt_key, vec_bytes, answer):
+        try:
+            with self._db_lock:
+                self._cache_db.execute(
+                    "INSERT OR REPLACE INTO semantic_cache (prompt_key, vec_hash, vec, answer) VALUES (?, ?, ?, ?)",
+                    (prompt_key, hashlib.blake2b(vec_bytes).hexdigest(), vec_bytes, answer)
+                )
+                self._cache_db.execute(
+                    "DELETE FROM semantic_cache WHERE prompt_key = ? AND rowid NOT IN "
+                    "(SELECT rowid FROM semantic_cache WHERE prompt_key = ? ORDER BY rowid DESC LIMIT ?)",
+                    (prompt_key, prompt_key, RESPONSE_CACHE_SIZE)
+                )
+                self._cache_db.commit()
+        except sqlite3.Error as e:
+            print(f"Failed to persist semantic cache entry: {e}")
+
+    def _record_unknown_once(self, question):
+        """Record an unknown question unless the same one was recorded within the last minute"""
+        key = hash(question)
+        now = time.time()
+        while self._recent_unknowns and now - next(iter(self._recent_unknowns.values())) > UNKNOWN_EVICT_SECONDS:
+            self._recent_unknowns.popitem(last=False)
+        last = self._recent_unknowns.get(key)
+        if last is not None and now - last < UNKNOWN_DEDUPE_SECONDS:
+            print("Skipping duplicate unknown question", flush=True)
+            return {"recorded": "ok"}
+        self._recent_unknowns[key] = now
+        self._recent_unknowns.move_to_end(key)
+        return record_unknown_question(question=question)
 
     def handle_tool_call(self, tool_calls):
         results = []
         for tool_call in tool_calls:
-            tool_name = tool_call.function.name
-            arguments = json.loads(tool_call.function.arguments)
+            tool_name = tool_call["function"]["name"]
+            arguments = orjson.loads(tool_call["function"]["arguments"] or "{}")
             print(f"Tool called: {tool_name}", flush=True)
-            tool = globals().get(tool_name)
-            result = tool(**arguments) if tool else {}
-            results.append({"role": "tool","content": json.dumps(result),"tool_call_id": tool_call.id})
+            if tool_name == "record_unknown_question":
+                result = self._record_unknown_once(**arguments)
+            else:
+                tool = globals().get(tool_name)
+                result = tool(**arguments) if tool else {}
+            results.append({"role": "tool","content": orjson.dumps(result).decode(),"tool_call_id": tool_call["id"]})
         return results
 
-    def system_prompt(self):
+    def _accumulate_tool_calls(self, tool_calls, deltas):
+        """Merge streamed tool call fragments into complete calls, keyed by index"""
+        for delta in deltas:
+            call = tool_calls.setdefault(delta.index, {"id": "", "type": "function", "function": {"name": "", "arguments": ""}})
+            if delta.id:
+                call["id"] = delta.id
+            if delta.function:
+                call["function"]["name"] += delta.function.name or ""
+                call["function"]["arguments"] += delta.function.arguments or ""
+
+    def _retrieve(self, query_vec, k=KB_TOP_K):
+        """Return the k knowledge base chunks most similar to the query, in document order"""
+        kb_chunks, kb_vecs = self._kb
+        if not kb_chunks:
+            return []
+        sims = kb_vecs @ query_vec
+        top = np.argsort(-sims)[:k]
+        return [kb_chunks[i] for i in sorted(top)]
+
+    def _build_system_prompt(self):
         return f"""You are acting as {self.name}, a professional AI assistant representing {self.name} on their personal website.
 Your responsibilities include:
-- Answering questions ONLY based on the knowledge base below. Do NOT answer if the information is not contained in the knowledge base.
+- Answering questions ONLY based on the knowledge base content provided with each question. Do NOT answer if the information is not contained in the knowledge base.
 - If you do NOT know the answer from the knowledge base, respond: "I don't know" and record the question.
 - Engage professionally and politely.
 - Use tools to record unknown questions and user details.
 - NEVER make up information or guess beyond the knowledge base.
 
-Knowledge Base Content:
-{self.knowledge_base_text}
-
 Guidelines:
 - Be professional, friendly, and helpful.
 - Stay strictly on topic about {self.name}'s professional background."""
 
-    def chat(self, message, history):
-        # Clean history keys to avoid Groq errors
-        history = [{k: v for k, v in item.items() if k not in ('metadata', 'options')} for item in history]
-        messages = [{"role": "system", "content": self.system_prompt()}] + history + [{"role": "user", "content": message}]
+    def _knowledge_message(self, query_vec):
+        knowledge = "\n\n".join(self._retrieve(query_vec))
+        return {"role": "system", "content": f"Knowledge Base Content:\n{knowledge}"}
+
+    async def chat(self, message, history):
+        """Stream an answer to message; history must already hold plain role/content dicts"""
+        if not self._ready.is_set():
+            await asyncio.to_thread(self._ready.wait)
+        if self._load_error is not None:
+            # A failed load is not permanent: retry it so a transient error does not need a restart
+            await asyncio.to_thread(self._retry_load)
+        if self._dirty.is_set():
+            await asyncio.to_thread(self._reload_documents)
+
+        # Identical conversations get the stored answer without calling Groq
+        cache_key = self._cache_key(history, message)
+        cached = self._cached_answer(cache_key)
+        if cached is None:
+            cached = await asyncio.to_thread(self._stored_answer, cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+        # Paraphrases of an opening question reuse an earlier answer; later turns depend on context
+        query_vec = await asyncio.to_thread(self._embed, message)
+        if not history:
+            cached = self._semantic_answer(query_vec)
+            if cached is not None:
+                yield cached
+                return
+
+        # The static system message and history stay a stable prefix; only the retrieved context changes per turn
+        messages = [self._system_message, *history, self._knowledge_message(query_vec), {"role": "user", "content": message}]
         done = False
         recorded_unknown = False
+        tool_fired = False
         while not done:
-            response = self.groq.chat.completions.create(
-                model="llama-3.3-70b-versatile", 
-                messages=messages, 
-                tools=tools,
-                temperature=0.7
-            )
-            if response.choices[0].finish_reason == "tool_calls":
-                message_obj = response.choices[0].message
-                tool_calls = message_obj.tool_calls
+            # Queue locally within the rate limits instead of bursting into 429s and client backoff
+            estimated_tokens = sum(len(m.get("content") or "") for m in messages) // 4 + GROQ_MAX_TOKENS
+            await self._token_bucket.acquire(min(estimated_tokens, GROQ_TPM))
+            async with self._bucket:
+                stream = await self.groq.chat.completions.create(
+                    model="llama-3.3-70b-versatile", 
+                    messages=messages, 
+                    tools=tools,
+                    temperature=0.7,
+                    max_tokens=GROQ_MAX_TOKENS,
+                    stream=True
+                )
+            # Yield the growing answer as tokens arrive; tool calls are collected until the stream ends
+            answer = ""
+            tool_calls = {}
+            finish_reason = None
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                choice = chunk.choices[0]
+                if choice.delta.content:
+                    answer += choice.delta.content
+                    yield answer
+                if choice.delta.tool_calls:
+                    self._accumulate_tool_calls(tool_calls, choice.delta.tool_calls)
+                if choice.finish_reason:
+                    finish_reason = choice.finish_reason
+
+            if finish_reason == "tool_calls":
+                tool_calls = [tool_calls[index] for index in sorted(tool_calls)]
                 results = self.handle_tool_call(tool_calls)
-                messages.append(message_obj)
+                tool_fired = True
+                if any(call["function"]["name"] == "record_unknown_question" for call in tool_calls):
+                    recorded_unknown = True
+                messages.append({"role": "assistant", "content": answer or None, "tool_calls": tool_calls})
                 messages.extend(results)
             else:
                 done = True
 
-        answer = response.choices[0].message.content
-
         # Check if answer indicates lack of knowledge, then record unknown question
-        if any(phrase in answer.lower() for phrase in ["i don't know", "cannot answer", "not in my knowledge base", "no information"]):
+        if _UNKNOWN_RE.search(answer):
             if not recorded_unknown:
-                record_unknown_question(question=message)
+                self._record_unknown_once(message)
                 recorded_unknown = True
 
-        return answer
+        # Answers that triggered tools had side effects, so they are never replayed
+        if answer and not tool_fired:
+            self._remember_answer(cache_key, answer)
+            if not history:
+                self._remember_semantic(query_vec, answer)
+
+def to_groq_messages(turns):
+    """Convert (user, bot) chatbot turns into Groq role/content dicts, dropping empty bot messages"""
+    return list(chain.from_iterable(
+        [{"role": "user", "content": user_msg}] + ([{"role": "assistant", "content": bot_msg}] if bot_msg else [])
+        for user_msg, bot_msg in turns
+    ))
 
 def submit_contact(name, email):
     if email:
@@ -315,6 +784,8 @@ if __name__ == "__main__":
             avatar_images=("user.png", "bot.png"),
             height=500
         )
+        # Per-session Groq history, so each turn only converts the turns added since the last one
+        groq_state = gr.State({"turns": 0, "messages": []})
 
         # Input area with textbox and button
         with gr.Row():
@@ -344,30 +815,39 @@ if __name__ == "__main__":
             label="💡 Example Questions"
         )
 
-        def respond(message, chat_history, name, email):
+        async def respond(message, chat_history, groq_history, name, email):
             if not message.strip():  # Don't respond to empty messages
-                return chat_history
+                yield chat_history, groq_history
+                return
                 
-            groq_history = []
-            for user_msg, bot_msg in chat_history:
-                groq_history.append({"role": "user", "content": user_msg})
-                if bot_msg:  # Only add non-empty bot messages
-                    groq_history.append({"role": "assistant", "content": bot_msg})
-
-            response = me.chat(message, groq_history)
-            chat_history.append((message, response))
+            # Build Groq-ready role/content dicts here so chat() never has to clean the history;
+            # rebuild from scratch if the chatbot holds fewer turns than the cached history
+            if groq_history["turns"] > len(chat_history):
+                groq_history = {"turns": 0, "messages": []}
+            groq_history["messages"].extend(to_groq_messages(chat_history[groq_history["turns"]:]))
+            groq_history["turns"] = len(chat_history)
+
+            # Show the user's message right away, then stream the answer into the last turn
+            chat_history.append((message, ""))
+            yield chat_history, groq_history
+            async for partial in me.chat(message, groq_history["messages"]):
+                chat_history[-1] = (message, partial)
+                yield chat_history, groq_history
+
+            groq_history["messages"].extend(to_groq_messages(chat_history[-1:]))
+            groq_history["turns"] = len(chat_history)
+            yield chat_history, groq_history
 
             if email:
                 record_user_details(email=email, name=name or "Name not provided", notes=f"From chat: {message}")
 
-            return chat_history
-
         # Handle both Enter key and button click
         textbox.submit(
             fn=respond,
-            inputs=[textbox, chatbot, name_input, email_input],
-            outputs=[chatbot],
-            queue=False
+            inputs=[textbox, chatbot, groq_state, name_input, email_input],
+            outputs=[chatbot, groq_state],
+            concurrency_limit=CHAT_CONCURRENCY,
+            concurrency_id="chat"
         ).then(
             lambda: "",
             outputs=[textbox]
@@ -375,9 +855,10 @@ if __name__ == "__main__":
         
         submit_btn.click(
             fn=respond,
-            inputs=[textbox, chatbot, name_input, email_input],
-            outputs=[chatbot],
-            queue=False
+            inputs=[textbox, chatbot, groq_state, name_input, email_input],
+            outputs=[chatbot, groq_state],
+            concurrency_limit=CHAT_CONCURRENCY,
+            concurrency_id="chat"
         ).then(
             lambda: "",
             outputs=[textbox]